@@ -1,3 +1,200 @@
-from django.test import TestCase
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+import pybase64
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from .views import ImageAnalyzer
+
+
+def make_jpeg(size=(64, 64)) -> bytes:
+    """Encode a solid-colour JPEG in memory"""
+    buf = BytesIO()
+    Image.new('RGB', size, 'red').save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+def make_completion(content, finish_reason='stop', refusal=None):
+    """Build a stand-in for an OpenAI chat completion with a single choice"""
+    message = mock.Mock(content=content, refusal=refusal)
+    return mock.Mock(choices=[mock.Mock(message=message, finish_reason=finish_reason)])
+
+
+INGREDIENTS = [{"name": "eggs", "confidence": 0.9}]
+INGREDIENTS_JSON = '{"ingredients": [{"name": "eggs", "confidence": 0.9}]}'
+INGREDIENTS_FALLBACK = [{"name": "Unable to identify ingredients", "confidence": 0.1}]
+
+
+@override_settings(OPENAI_API_KEY='test-key')
+class AnalyzeImagesUploadTests(TestCase):
+    """Upload validation in analyze_images, exercised without reaching OpenAI"""
+
+    def setUp(self):
+        # The throttle and the ingredient cache both live in the default cache
+        cache.clear()
+        self.url = reverse('analyze_images')
+
+    @mock.patch.object(ImageAnalyzer, 'analyze_ingredients')
+    @mock.patch.object(ImageAnalyzer, 'prepare_image')
+    def test_wrong_magic_bytes_rejected_before_decoding(self, prepare_image, analyze_ingredients):
+        junk = SimpleUploadedFile('photo.jpg', b'not really an image', content_type='image/jpeg')
+
+        response = self.client.post(self.url, {'image_0': junk})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('photo.jpg', response.json()['detail'])
+        prepare_image.assert_not_called()
+        analyze_ingredients.assert_not_called()
+
+    @mock.patch.object(ImageAnalyzer, 'validate_image')
+    def test_more_than_three_images_rejected_before_validation(self, validate_image):
+        files = {
+            f'image_{i}': SimpleUploadedFile(f'photo{i}.jpg', b'\xff\xd8\xff', content_type='image/jpeg')
+            for i in range(4)
+        }
+
+        response = self.client.post(self.url, files)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['detail'], 'Maximum 3 images allowed')
+        validate_image.assert_not_called()
+
+    @mock.patch.object(ImageAnalyzer, 'analyze_ingredients')
+    def test_truncated_jpeg_rejected_by_prepare_image(self, analyze_ingredients):
+        data = make_jpeg((512, 512))
+        truncated = SimpleUploadedFile('photo.jpg', data[:len(data) // 2], content_type='image/jpeg')
+
+        response = self.client.post(self.url, {'image_0': truncated})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('photo.jpg', response.json()['detail'])
+        analyze_ingredients.assert_not_called()
+
+
+class PrepareImageTests(TestCase):
+    """Decoding, downscaling and JPEG re-encoding of uploads"""
+
+    @staticmethod
+    def prepare(data: bytes, name: str = 'photo.jpg', content_type: str = 'image/jpeg') -> Image.Image:
+        encoded = ImageAnalyzer.prepare_image(SimpleUploadedFile(name, data, content_type=content_type))
+        return Image.open(BytesIO(pybase64.b64decode(encoded)))
+
+    def test_large_images_downscaled_to_jpeg(self):
+        buf = BytesIO()
+        Image.new('RGB', (2048, 1024), 'blue').save(buf, 'PNG')
+        uploads = {
+            'jpeg': (make_jpeg((3000, 2000)), 'photo.jpg', 'image/jpeg'),
+            'png': (buf.getvalue(), 'photo.png', 'image/png'),
+        }
+        for case, upload in uploads.items():
+            with self.subTest(case):
+                img = self.prepare(*upload)
+
+                self.assertEqual(img.format, 'JPEG')
+                self.assertEqual(max(img.size), 1024)
+
+    def test_exif_rotation_applied(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise
+        buf = BytesIO()
+        Image.new('RGB', (200, 100), 'red').save(buf, 'JPEG', exif=exif)
+
+        img = self.prepare(buf.getvalue())
+
+        self.assertEqual(img.size, (100, 200))
+
+    def test_transparency_flattened_onto_white(self):
+        buf = BytesIO()
+        Image.new('RGBA', (32, 32), (0, 0, 0, 0)).save(buf, 'PNG')
+
+        img = self.prepare(buf.getvalue(), 'photo.png', 'image/png')
+
+        self.assertTrue(all(channel > 250 for channel in img.getpixel((16, 16))))
+
+
+class AnalyzeIngredientsTests(TestCase):
+    """Parsing of the structured-output ingredient completion"""
+
+    @mock.patch('api.views.client')
+    def test_parses_ingredients(self, client):
+        client.chat.completions.create.return_value = make_completion(INGREDIENTS_JSON)
+
+        self.assertEqual(ImageAnalyzer.analyze_ingredients(['aW1n']), INGREDIENTS)
+
+    @mock.patch('api.views.client')
+    def test_truncated_output_returns_fallback(self, client):
+        client.chat.completions.create.return_value = make_completion('{"ingredients": [', finish_reason='length')
+
+        self.assertEqual(ImageAnalyzer.analyze_ingredients(['aW1n']), INGREDIENTS_FALLBACK)
+
+    @mock.patch('api.views.client')
+    def test_refusal_returns_fallback(self, client):
+        client.chat.completions.create.return_value = make_completion(None, refusal="I can't help with that.")
+
+        with self.assertLogs('api.views', level='WARNING') as logs:
+            self.assertEqual(ImageAnalyzer.analyze_ingredients(['aW1n']), INGREDIENTS_FALLBACK)
+
+        self.assertIn("refused to analyze images: I can't help with that.", logs.output[0])
+
+
+@override_settings(OPENAI_API_KEY='test-key', OPENAI_CACHE_TIMEOUT=123)
+class IngredientCacheTests(TestCase):
+    """Ingredient results cached by a content hash of the uploads"""
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('analyze_images')
+
+    def test_key_independent_of_file_order(self):
+        first = SimpleUploadedFile('a.jpg', make_jpeg((32, 32)), content_type='image/jpeg')
+        second = SimpleUploadedFile('b.jpg', make_jpeg((48, 48)), content_type='image/jpeg')
+
+        self.assertEqual(
+            ImageAnalyzer.images_cache_key([first, second]),
+            ImageAnalyzer.images_cache_key([second, first])
+        )
+
+    @mock.patch('api.views.client')
+    def test_repeat_upload_skips_encoding_and_openai(self, client):
+        client.chat.completions.create.return_value = make_completion(INGREDIENTS_JSON)
+        data = make_jpeg()
+
+        first = self.client.post(self.url, {'image_0': SimpleUploadedFile('a.jpg', data, content_type='image/jpeg')})
+        with mock.patch.object(ImageAnalyzer, 'prepare_image') as prepare_image:
+            second = self.client.post(self.url, {'image_0': SimpleUploadedFile('b.jpg', data, content_type='image/jpeg')})
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()['ingredients'], INGREDIENTS)
+        prepare_image.assert_not_called()
+        self.assertEqual(client.chat.completions.create.call_count, 1)
+
+    @mock.patch('api.views.cache')
+    @mock.patch('api.views.client')
+    def test_parsed_ingredients_cached_with_timeout(self, client, views_cache):
+        client.chat.completions.create.return_value = make_completion(INGREDIENTS_JSON)
+
+        ingredients = ImageAnalyzer.analyze_ingredients(['aW1n'], cache_key='ingredients:key')
+
+        self.assertEqual(ingredients, INGREDIENTS)
+        views_cache.set.assert_called_once_with('ingredients:key', INGREDIENTS, 123)
+
+    @mock.patch('api.views.cache')
+    @mock.patch('api.views.client')
+    def test_fallback_not_cached(self, client, views_cache):
+        completions = {
+            'parse failure': make_completion('not json'),
+            'truncated': make_completion('{"ingredients": [', finish_reason='length'),
+        }
+        for case, completion in completions.items():
+            with self.subTest(case):
+                client.chat.completions.create.return_value = completion
+
+                ingredients = ImageAnalyzer.analyze_ingredients(['aW1n'], cache_key='ingredients:key')
+
+                self.assertEqual(ingredients, INGREDIENTS_FALLBACK)
+                views_cache.set.assert_not_called()
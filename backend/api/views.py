@@ -1,12 +1,13 @@
-import base64
-import json
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files.uploadedfile import InMemoryUploadedFile
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.utils.decorators import method_decorator
@@ -15,14 +16,27 @@ from rest_framework.decorators import api_view, throttle_classes
 from rest_framework.throttling import AnonRateThrottle
 from rest_framework.response import Response
 from rest_framework import status
-from PIL import Image
-from openai import OpenAI
+import httpx
+import orjson
+import pybase64
+from PIL import Image, ImageOps
+from openai import DefaultHttpxClient, OpenAI
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
-client = OpenAI(api_key=settings.OPENAI_API_KEY) if settings.OPENAI_API_KEY else None
+# Initialize OpenAI client over a pooled HTTP/2 connection so calls reuse the TLS session
+client = OpenAI(
+    api_key=settings.OPENAI_API_KEY,
+    http_client=DefaultHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+    ),
+    # One retry covers a stale pooled connection, 429 or 5xx; two 14s attempts
+    # plus the SDK's ~0.5s backoff stay inside the frontend's 30s request timeout
+    timeout=14.0,
+    max_retries=1
+) if settings.OPENAI_API_KEY else None
 
 # Log client initialization
 if client:
@@ -30,12 +44,102 @@ if client:
 else:
     logger.warning("OpenAI client NOT initialized - API key missing")
 
+# Uploads are re-encoded to JPEG no larger than this before being sent to OpenAI
+IMAGE_MAX_DIMENSION = 1024
+ENCODED_IMAGE_FORMAT = 'JPEG'
+ENCODED_IMAGE_MIME_TYPE = 'image/jpeg'
+JPEG_QUALITY = 85
+
+# Leading bytes of the accepted formats: JPEG, PNG, BMP
+IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'BM')
+IMAGE_SIGNATURE_LENGTH = max(map(len, IMAGE_SIGNATURES))
+
+# Prompts are constant, so build them once at import time
+INGREDIENT_PROMPT = {
+    "type": "text",
+    "text": "Analyze these images and identify all cooking ingredients you can see. Return a JSON object with an 'ingredients' array of objects with 'name' and 'confidence' fields. Only include ingredients that are clearly visible and identifiable. Be specific about the ingredient names (e.g., 'fresh tomatoes' not just 'tomatoes')."
+}
+# Data URLs advertise the format uploads are re-encoded to, whatever was uploaded
+IMAGE_URL_TEMPLATE = f"data:{ENCODED_IMAGE_MIME_TYPE};base64,{{}}"
+RECIPE_PROMPT_TEMPLATE = """
+            Based on these ingredients: {ingredients_text}
+            
+            Generate 3 different recipes that can be made with these ingredients. For each recipe, return a JSON object with:
+            - title: Recipe name
+            - usedIngredients: Array of ingredients from the provided list that are used
+            - instructions: Array of step-by-step cooking instructions
+            - difficulty: "easy", "medium", or "hard"
+            - timeMinutes: Estimated cooking time in minutes
+            
+            Return only a JSON object with a "recipes" array of 3 recipe objects, no other text.
+            """
+
+# Structured outputs guarantee the completion parses as JSON matching these schemas
+INGREDIENTS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "ingredients",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "ingredients": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string"},
+                            "confidence": {"type": "number"}
+                        },
+                        "required": ["name", "confidence"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["ingredients"],
+            "additionalProperties": False
+        }
+    }
+}
+RECIPES_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "recipes",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "recipes": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "title": {"type": "string"},
+                            "usedIngredients": {"type": "array", "items": {"type": "string"}},
+                            "instructions": {"type": "array", "items": {"type": "string"}},
+                            "difficulty": {"type": "string", "enum": ["easy", "medium", "hard"]},
+                            "timeMinutes": {"type": "integer"}
+                        },
+                        "required": ["title", "usedIngredients", "instructions", "difficulty", "timeMinutes"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["recipes"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Shared pool for encoding uploads in parallel (at most 3 images per request)
+_ENCODE_POOL = ThreadPoolExecutor(max_workers=3, thread_name_prefix='image-encode')
+
 class ImageAnalyzer:
     """Handles image analysis and recipe generation using OpenAI Vision API"""
     
     @staticmethod
     def validate_image(file: InMemoryUploadedFile) -> bool:
-        """Validate image file type and size"""
+        """Validate image file type and size (image contents are checked in prepare_image)"""
         # Check file size
         if file.size > settings.MAX_UPLOAD_SIZE:
             return False
@@ -45,43 +149,77 @@ class ImageAnalyzer:
         if file.content_type not in allowed_types:
             return False
         
-        # Verify it's actually an image using PIL
+        # Sniff the magic bytes so junk is rejected before PIL reads the whole file
+        file.seek(0)
+        head = file.read(IMAGE_SIGNATURE_LENGTH)
+        file.seek(0)
+        return head.startswith(IMAGE_SIGNATURES)
+    
+    @staticmethod
+    def prepare_image(file: InMemoryUploadedFile) -> Optional[str]:
+        """Decode, downscale and re-encode an upload as base64 JPEG in a single pass.
+        
+        Returns None if the file is not a decodable image.
+        """
         try:
             file.seek(0)
             with Image.open(file) as img:
-                img.verify()
-            file.seek(0)
-            return True
+                # Let libjpeg scale down by 1/2, 1/4 or 1/8 while decoding DCT blocks
+                if img.format == 'JPEG':
+                    img.draft('RGB', (IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+                
+                # Decoding here doubles as validation: corrupt data raises
+                img.load()
+                
+                # The Vision API downsamples server-side anyway, so send no more than it uses
+                ImageOps.exif_transpose(img, in_place=True)
+                img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.Resampling.BILINEAR)
+                
+                # JPEG has no alpha; flatten onto white so transparent areas don't turn black
+                if img.has_transparency_data:
+                    rgba = img.convert('RGBA')
+                    img = Image.new('RGB', rgba.size, 'white')
+                    img.paste(rgba, mask=rgba.getchannel('A'))
+                
+                buf = BytesIO()
+                img.convert('RGB').save(buf, ENCODED_IMAGE_FORMAT, quality=JPEG_QUALITY, optimize=True)
         except Exception:
-            return False
+            return None
+        
+        # pybase64 dispatches to SIMD (AVX2/SSSE3/NEON) and returns str directly
+        with buf.getbuffer() as data:
+            return pybase64.b64encode_as_string(data)
     
     @staticmethod
-    def encode_image_to_base64(file: InMemoryUploadedFile) -> str:
-        """Convert uploaded file to base64 string"""
-        file.seek(0)
-        file_data = file.read()
-        return base64.b64encode(file_data).decode('utf-8')
+    def images_cache_key(files: List[InMemoryUploadedFile]) -> str:
+        """Build a cache key from the raw bytes of the uploads, independent of order"""
+        digests = []
+        for file in files:
+            file.seek(0)
+            hasher = hashlib.blake2b(digest_size=16)
+            for chunk in file.chunks():
+                hasher.update(chunk)
+            digests.append(hasher.digest())
+        file_hash = hashlib.blake2b(b''.join(sorted(digests)), digest_size=16)
+        return f"ingredients:{file_hash.hexdigest()}"
     
     @staticmethod
-    def analyze_ingredients(images: List[str]) -> List[Dict[str, Any]]:
-        """Use OpenAI Vision to extract ingredients from images"""
+    def analyze_ingredients(images: List[str], cache_key: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Use OpenAI Vision to extract ingredients from images, caching parsed results under cache_key"""
         try:
             # Prepare messages for OpenAI Vision API
             content = [
-                {
-                    "type": "text",
-                    "text": "Analyze these images and identify all cooking ingredients you can see. Return a JSON array of objects with 'name' and 'confidence' fields. Only include ingredients that are clearly visible and identifiable. Be specific about the ingredient names (e.g., 'fresh tomatoes' not just 'tomatoes')."
-                }
-            ]
-            
-            # Add image data
-            for i, image_data in enumerate(images):
-                content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{image_data}"
+                INGREDIENT_PROMPT,
+                *(
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": IMAGE_URL_TEMPLATE.format(image_data)
+                        }
                     }
-                })
+                    for image_data in images
+                )
+            ]
             
             logger.info(f"Calling OpenAI with {len(images)} images")
             logger.info(f"API Key present: {bool(settings.OPENAI_API_KEY)}")
@@ -96,26 +234,31 @@ class ImageAnalyzer:
                     }
                 ],
                 max_tokens=1000,
-                temperature=0.1
+                temperature=0.1,
+                response_format=INGREDIENTS_RESPONSE_FORMAT
             )
             
             # Parse the response
-            content = response.choices[0].message.content
+            choice = response.choices[0]
+            content = choice.message.content
+            
+            # Output cut off at max_tokens is incomplete JSON, so don't try to parse it
+            if choice.finish_reason == "length":
+                logger.warning(f"OpenAI response truncated at max_tokens: {content}")
+                return [{"name": "Unable to identify ingredients", "confidence": 0.1}]
             
-            # Try to extract JSON from the response
+            # Structured output reports refusals separately and leaves content empty
+            if choice.message.refusal:
+                logger.warning(f"OpenAI refused to analyze images: {choice.message.refusal}")
+                return [{"name": "Unable to identify ingredients", "confidence": 0.1}]
+            
+            # Structured output returns a bare object matching the schema, so parse it directly
             try:
-                # Look for JSON in the response
-                start_idx = content.find('[')
-                end_idx = content.rfind(']') + 1
-                if start_idx != -1 and end_idx != 0:
-                    json_str = content[start_idx:end_idx]
-                    ingredients = json.loads(json_str)
-                    return ingredients
-                else:
-                    # Fallback: try to parse the entire response
-                    ingredients = json.loads(content)
-                    return ingredients
-            except json.JSONDecodeError:
+                ingredients = orjson.loads(content)["ingredients"]
+                if cache_key:
+                    cache.set(cache_key, ingredients, settings.OPENAI_CACHE_TIMEOUT)
+                return ingredients
+            except (orjson.JSONDecodeError, KeyError):
                 # If JSON parsing fails, create a simple response
                 logger.warning(f"Failed to parse JSON from OpenAI response: {content}")
                 return [{"name": "Unable to identify ingredients", "confidence": 0.1}]
@@ -132,18 +275,7 @@ class ImageAnalyzer:
             ingredient_names = [ing['name'] for ing in ingredients]
             ingredients_text = ", ".join(ingredient_names)
             
-            prompt = f"""
-            Based on these ingredients: {ingredients_text}
-            
-            Generate 3 different recipes that can be made with these ingredients. For each recipe, return a JSON object with:
-            - title: Recipe name
-            - usedIngredients: Array of ingredients from the provided list that are used
-            - instructions: Array of step-by-step cooking instructions
-            - difficulty: "easy", "medium", or "hard"
-            - timeMinutes: Estimated cooking time in minutes
-            
-            Return only a JSON array of 3 recipe objects, no other text.
-            """
+            prompt = RECIPE_PROMPT_TEMPLATE.format(ingredients_text=ingredients_text)
             
             """
             response = client.chat.completions.create(
@@ -155,25 +287,17 @@ class ImageAnalyzer:
                     }
                 ],
                 max_tokens=2000,
-                temperature=0.7
+                temperature=0.7,
+                response_format=RECIPES_RESPONSE_FORMAT
             )
             
             content = response.choices[0].message.content
             
-            # Parse the response
+            # Structured output returns a bare object matching the schema, so parse it directly
             try:
-                # Look for JSON array in the response
-                start_idx = content.find('[')
-                end_idx = content.rfind(']') + 1
-                if start_idx != -1 and end_idx != 0:
-                    json_str = content[start_idx:end_idx]
-                    recipes = json.loads(json_str)
-                    return recipes
-                else:
-                    # Fallback: try to parse the entire response
-                    recipes = json.loads(content)
-                    return recipes
-            except json.JSONDecodeError:
+                recipes = orjson.loads(content)["recipes"]
+                return recipes
+            except (orjson.JSONDecodeError, KeyError):
                 logger.warning(f"Failed to parse JSON from OpenAI response: {content}")
                 return [{
                     "title": "Unable to generate recipes",
@@ -208,6 +332,13 @@ def analyze_images(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        # Reject oversized batches before doing any per-file work
+        if len(files) > 3:
+            return Response(
+                {'detail': 'Maximum 3 images allowed'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
         # Validate files
         valid_files = []
         for key, file in files.items():
@@ -218,29 +349,33 @@ def analyze_images(request):
                 )
             valid_files.append(file)
         
-        if len(valid_files) > 3:
-            return Response(
-                {'detail': 'Maximum 3 images allowed'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        # Convert images to base64
-        image_data = []
-        for file in valid_files:
-            base64_data = ImageAnalyzer.encode_image_to_base64(file)
-            image_data.append(base64_data)
-        
-        # Analyze ingredients
-        ingredients = ImageAnalyzer.analyze_ingredients(image_data)
+        # Skip encoding and the Vision call entirely for previously seen images
+        ingredients_key = ImageAnalyzer.images_cache_key(valid_files)
+        ingredients = cache.get(ingredients_key)
+        if ingredients is None:
+            # Decode and convert images to base64 concurrently (PIL and pybase64 release the GIL)
+            image_data = list(_ENCODE_POOL.map(ImageAnalyzer.prepare_image, valid_files))
+            for file, base64_data in zip(valid_files, image_data):
+                if base64_data is None:
+                    return Response(
+                        {'detail': f'Invalid file: {file.name}. Must be JPG, PNG, or BMP under 10MB'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+            
+            # Analyze ingredients
+            ingredients = ImageAnalyzer.analyze_ingredients(image_data, cache_key=ingredients_key)
         
         # Generate recipes
         recipes = ImageAnalyzer.generate_recipes(ingredients)
         
-        # Return results
-        return Response({
-            'ingredients': ingredients,
-            'recipes': recipes
-        })
+        # Return results, serialized with orjson rather than DRF's JSONRenderer
+        return HttpResponse(
+            orjson.dumps({
+                'ingredients': ingredients,
+                'recipes': recipes
+            }),
+            content_type='application/json'
+        )
         
     except Exception as e:
         logger.error(f"Error in analyze_images: {str(e)}")
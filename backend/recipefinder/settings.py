@@ -140,6 +140,7 @@ ALLOWED_IMAGE_TYPES = os.getenv('ALLOWED_IMAGE_TYPES', 'jpg,jpeg,png,bmp').split
 
 # OpenAI settings
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_CACHE_TIMEOUT = int(os.getenv('OPENAI_CACHE_TIMEOUT', '86400'))  # 24 hours
 
 # REST Framework settings
 REST_FRAMEWORK = {